@@ -3,8 +3,10 @@ import io
 import time
 import wave
 import grpc
+import logging
 import threading
-import queue
+from concurrent.futures import ThreadPoolExecutor
+import collections
 import argparse
 import numpy as np
 import os
@@ -13,18 +15,37 @@ import os
 import vad_pb2
 import vad_pb2_grpc
 
+log = logging.getLogger(__name__)
+
 # Audio parameters
 SAMPLE_RATE = 16000
 # Silero VAD requires exactly 512 samples per chunk at 16kHz
 VAD_CHUNK_SIZE = 512
+# Send each small audio message as soon as it is written
+CHANNEL_OPTIONS = [
+    ("grpc.http2.write_buffer_size", 0),
+    ("grpc.max_send_message_length", 4 << 20),
+]
+# Chunks read from the WAV file per read call (1 MB of 16-bit mono audio)
+READ_BLOCK_CHUNKS = 1024
 
 class FileVADClient:
-    def __init__(self, server_address='localhost:50051', wav_file=None):
+    # Shared by all clients so background runs reuse threads
+    _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="vad-client")
+    
+    def __init__(self, server_address='localhost:50051', wav_file=None, realtime=False):
         self.server_address = server_address
         self.wav_file = wav_file
+        # Pace the stream at playback speed instead of sending as fast as possible
+        self.realtime = realtime
         self.running = False
-        self.vad_events_queue = queue.Queue()
-        self.stt_queue = queue.Queue()
+        # deque append/popleft are thread-safe; stt_event wakes the consumer
+        self.vad_events_queue = collections.deque()
+        self.stt_queue = collections.deque()
+        self.stt_event = threading.Event()
+        # One channel shared by all RPCs of this client
+        self.channel = grpc.insecure_channel(server_address, options=CHANNEL_OPTIONS)
+        self.stub = vad_pb2_grpc.VADServiceStub(self.channel)
     
     def read_wav_file(self):
         """Generator that yields chunks from a WAV file with correct size for Silero VAD"""
@@ -32,38 +53,48 @@ class FileVADClient:
             with wave.open(self.wav_file, 'rb') as wf:
                 # Validate audio format
                 if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getframerate() != SAMPLE_RATE:
-                    print(f"Warning: WAV file should be mono, 16-bit, {SAMPLE_RATE}Hz")
-                    print(f"Current file: channels={wf.getnchannels()}, sampwidth={wf.getsampwidth()}, framerate={wf.getframerate()}")
+                    log.warning("WAV file should be mono, 16-bit, %dHz", SAMPLE_RATE)
+                    log.warning("Current file: channels=%d, sampwidth=%d, framerate=%d",
+                                wf.getnchannels(), wf.getsampwidth(), wf.getframerate())
                 
                 # Read chunks of exactly VAD_CHUNK_SIZE samples (each sample is 2 bytes for 16-bit audio)
                 bytes_per_chunk = VAD_CHUNK_SIZE * wf.getsampwidth()
                 
-                print(f"Processing audio in chunks of {VAD_CHUNK_SIZE} samples ({bytes_per_chunk} bytes)")
+                log.debug("Processing audio in chunks of %d samples (%d bytes)", VAD_CHUNK_SIZE, bytes_per_chunk)
                 
-                # Read the first chunk
-                data = wf.readframes(VAD_CHUNK_SIZE)
+                # Read large blocks and slice them into chunks, instead of
+                # going back to the file for every chunk
+                block_frames = VAD_CHUNK_SIZE * READ_BLOCK_CHUNKS
+                block = wf.readframes(block_frames)
                 
-                while data and self.running:
-                    # Check if we have a complete chunk
-                    if len(data) == bytes_per_chunk:
-                        yield data
-                    elif len(data) > 0:
-                        # If we have a partial chunk, pad it with zeros
-                        padding_needed = bytes_per_chunk - len(data)
-                        padded_data = data + b'\x00' * padding_needed
-                        print(f"Padded final chunk from {len(data)} to {bytes_per_chunk} bytes")
-                        yield padded_data
+                while block and self.running:
+                    view = memoryview(block)
+                    for start in range(0, len(view), bytes_per_chunk):
+                        if not self.running:
+                            break
+                        data = view[start:start + bytes_per_chunk]
+                        
+                        # Check if we have a complete chunk
+                        if len(data) == bytes_per_chunk:
+                            yield bytes(data)
+                        else:
+                            # If we have a partial chunk, pad it with zeros
+                            padding_needed = bytes_per_chunk - len(data)
+                            padded_data = bytes(data) + b'\x00' * padding_needed
+                            log.debug("Padded final chunk from %d to %d bytes", len(data), bytes_per_chunk)
+                            yield padded_data
+                        
+                        # Add a small delay to simulate real-time processing
+                        if self.realtime:
+                            time.sleep(VAD_CHUNK_SIZE / SAMPLE_RATE)  # Sleep for the duration of the chunk
                     
-                    # Add a small delay to simulate real-time processing
-                    time.sleep(VAD_CHUNK_SIZE / SAMPLE_RATE)  # Sleep for the duration of the chunk
-                    
-                    # Read the next chunk
-                    data = wf.readframes(VAD_CHUNK_SIZE)
+                    # Read the next block
+                    block = wf.readframes(block_frames)
                 
-                print("Finished reading file")
+                log.debug("Finished reading file")
                 
         except Exception as e:
-            print(f"Error reading WAV file: {e}")
+            log.error("Error reading WAV file: %s", e)
 
     def stream_file(self):
         """Stream audio from WAV file to VAD service"""
@@ -73,59 +104,60 @@ class FileVADClient:
         if not os.path.exists(self.wav_file):
             print(f"Error: File '{self.wav_file}' not found")
             return
-            
-        # Create a gRPC channel
-        with grpc.insecure_channel(self.server_address) as channel:
-            stub = vad_pb2_grpc.VADServiceStub(channel)
-            
-            # Function to generate audio chunks for streaming
-            def generate_audio_chunks():
-                for audio_chunk in self.read_wav_file():
-                    yield vad_pb2.AudioChunk(audio_data=audio_chunk)
-            
-            # Process responses from server
-            try:
-                for response in stub.ProcessAudio(generate_audio_chunks()):
-                    event = response.event
-                    message = response.message
-                    
-                    # Put event in queue for processing by main application
-                    self.vad_events_queue.put((event, message))
-                    
-                    # Print VAD events
-                    print(f"VAD event: {event} - {message}")
-                    
-                    # If speech ended, this audio could be sent for STT processing
-                    if event == "end":
-                        self.stt_queue.put(message)
-            except grpc.RpcError as e:
-                print(f"RPC error: {e}")
-            except Exception as e:
-                print(f"Error processing VAD responses: {e}")
-            
-            print("Finished processing file")
+        
+        # Function to generate audio chunks for streaming
+        def generate_audio_chunks():
+            for audio_chunk in self.read_wav_file():
+                yield vad_pb2.AudioChunk(audio_data=audio_chunk)
+        
+        # Process responses from server
+        try:
+            for response in self.stub.ProcessAudio(generate_audio_chunks()):
+                event = response.event
+                message = response.message
+                
+                # Heartbeats only signal that the server is alive; keep them
+                # out of the event queue and the normal output
+                if event == "heartbeat":
+                    log.debug("VAD heartbeat: %s", message)
+                    continue
+                
+                # Put event in queue for processing by main application
+                self.vad_events_queue.append((event, message))
+                
+                # Print VAD events
+                log.info("VAD event: %s - %s", event, message)
+                
+                # If speech ended, this audio could be sent for STT processing
+                if event == "end":
+                    self.stt_queue.append(message)
+                    self.stt_event.set()
+        except grpc.RpcError as e:
+            print(f"RPC error: {e}")
+        except Exception as e:
+            print(f"Error processing VAD responses: {e}")
+        
+        print("Finished processing file")
     
     def stop_streaming(self):
         """Stop streaming audio"""
         self.running = False
+        self.channel.close()
     
     def reset_vad(self):
         """Reset the VAD state on the server"""
-        with grpc.insecure_channel(self.server_address) as channel:
-            stub = vad_pb2_grpc.VADServiceStub(channel)
-            response = stub.ResetVAD(vad_pb2.ResetRequest())
-            return response.success
+        response = self.stub.ResetVAD(vad_pb2.ResetRequest())
+        return response.success
     
     def run_in_background(self):
-        """Run VAD streaming in a background thread"""
-        thread = threading.Thread(target=self.stream_file)
-        thread.daemon = True
-        thread.start()
-        return thread
+        """Run VAD streaming on the shared executor and return its future"""
+        return self._executor.submit(self.stream_file)
 
 
 # Example usage with a mock STT processor
 class STTProcessor:
+    _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stt-processor")
+    
     def __init__(self, vad_client):
         self.vad_client = vad_client
         self.running = False
@@ -133,26 +165,29 @@ class STTProcessor:
     def process_stt_queue(self):
         """Process the STT queue when VAD detects end of speech"""
         self.running = True
+        stt_queue = self.vad_client.stt_queue
+        stt_event = self.vad_client.stt_event
         while self.running:
-            try:
-                message = self.vad_client.stt_queue.get(timeout=1)
-                print(f"Processing STT: {message}")
-                # In a real application, you would send this audio to your STT service
-                # stt_result = your_stt_service.process(audio_data)
-                # print(f"STT result: {stt_result}")
-            except queue.Empty:
+            if not stt_event.wait(timeout=1):
                 if not self.vad_client.running:
                     # If the client is no longer running and queue is empty, exit
                     break
-            except Exception as e:
-                print(f"Error processing STT: {e}")
+                continue
+            # Clear before draining so a message added meanwhile sets it again
+            stt_event.clear()
+            while stt_queue:
+                try:
+                    message = stt_queue.popleft()
+                    print(f"Processing STT: {message}")
+                    # In a real application, you would send this audio to your STT service
+                    # stt_result = your_stt_service.process(audio_data)
+                    # print(f"STT result: {stt_result}")
+                except Exception as e:
+                    print(f"Error processing STT: {e}")
     
     def run_in_background(self):
-        """Run STT processing in a background thread"""
-        thread = threading.Thread(target=self.process_stt_queue)
-        thread.daemon = True
-        thread.start()
-        return thread
+        """Run STT processing on the shared executor and return its future"""
+        return self._executor.submit(self.process_stt_queue)
     
     def stop(self):
         """Stop STT processing"""
@@ -163,24 +198,27 @@ def main():
     parser = argparse.ArgumentParser(description='VAD Client for WAV files')
     parser.add_argument('--server', default='localhost:50055', help='gRPC server address')
     parser.add_argument('--file', required=True, help='Path to WAV file')
+    parser.add_argument('--realtime', action='store_true', help='Stream the file at playback speed')
     
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     
     try:
         # Create and start VAD client
-        vad_client = FileVADClient(server_address=args.server, wav_file=args.file)
-        vad_thread = vad_client.run_in_background()
+        vad_client = FileVADClient(server_address=args.server, wav_file=args.file,
+                                   realtime=args.realtime)
+        vad_future = vad_client.run_in_background()
         
         # Create and start STT processor
         stt_processor = STTProcessor(vad_client)
-        stt_thread = stt_processor.run_in_background()
+        stt_future = stt_processor.run_in_background()
         
         print(f"Processing file: {args.file}")
         print("Press Ctrl+C to stop.")
         
-        # Wait for threads to complete
-        vad_thread.join()
-        stt_thread.join()
+        # Wait for both to complete; result() re-raises their exceptions
+        vad_future.result()
+        stt_future.result()
         
     except KeyboardInterrupt:
         print("\nStopping...")
@@ -59,7 +59,10 @@ func wsHandler(w http.ResponseWriter, r *http.Request) {
 			log.Println("gRPC recv error:", err)
 			break
 		}
-		log.Printf("Received VAD response: %v\n", resp.GetEvent())
+		// Heartbeats arrive every ~512 ms; forward them without logging
+		if resp.GetEvent() != "heartbeat" {
+			log.Printf("Received VAD response: %v\n", resp.GetEvent())
+		}
 		ws.WriteJSON(resp)
 	}
 }
@@ -1,4 +1,8 @@
 # server.py
+import asyncio
+import copy
+import logging
+import os
 import numpy as np
 import torch
 import grpc
@@ -8,10 +12,116 @@ from concurrent import futures
 import vad_pb2
 import vad_pb2_grpc
 
+log = logging.getLogger(__name__)
+
+# Audio parameters
+SAMPLE_RATE = 16000
+# Silero VAD requires exactly 512 samples per chunk at 16kHz
+VAD_CHUNK_SIZE = 512
+VAD_CHUNK_BYTES = VAD_CHUNK_SIZE * 2  # 16-bit samples
+# Chunks whose mean absolute amplitude is below this are treated as silence
+# without running the model (only while no speech is in progress).
+# 0 disables the gate; calibrate against your own recordings before enabling.
+SILENCE_GATE = int(os.environ.get("VAD_SILENCE_GATE", "0"))
+# Send one heartbeat per this many continue chunks (~512 ms) as a liveness signal
+HEARTBEAT_CHUNKS = 16
+# Threads running VAD for all streams; 1 keeps model calls off the event loop
+# without letting them compete for the GIL
+MODEL_WORKERS = max(1, int(os.environ.get("VAD_MODEL_WORKERS", "1")))
+
+
+class OnnxVAD:
+    """Silero VAD on an ONNX Runtime session, called like the torch model"""
+    
+    # Samples carried over from the previous chunk at 16kHz
+    CONTEXT_SIZE = 64
+    
+    def __init__(self, path):
+        import onnxruntime
+        opts = onnxruntime.SessionOptions()
+        opts.intra_op_num_threads = 1
+        opts.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(
+            path, sess_options=opts, providers=['CPUExecutionProvider'])
+        self.reset_states()
+    
+    def __deepcopy__(self, memo):
+        # Sessions are thread-safe, so copies share one and only get new state
+        clone = copy.copy(self)
+        clone.reset_states()
+        return clone
+    
+    def reset_states(self, batch_size=1):
+        self._state = np.zeros((2, batch_size, 128), dtype=np.float32)
+        self._context = np.zeros((batch_size, self.CONTEXT_SIZE), dtype=np.float32)
+    
+    def __call__(self, x, sr):
+        x = x.numpy()
+        if x.shape[0] != self._state.shape[1]:
+            self.reset_states(x.shape[0])
+        x = np.concatenate([self._context, x], axis=1)
+        out, self._state = self.session.run(None, {
+            'input': x,
+            'state': self._state,
+            'sr': np.array(sr, dtype=np.int64),
+        })
+        self._context = x[:, -self.CONTEXT_SIZE:]
+        return torch.from_numpy(out)
+
+
+def load_onnx_model():
+    """Quantize the ONNX model shipped with silero-vad to int8 and load it"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    model_dir = os.path.join(torch.hub.get_dir(), 'snakers4_silero-vad_master',
+                             'src', 'silero_vad', 'data')
+    fp32_path = os.path.join(model_dir, 'silero_vad.onnx')
+    int8_path = os.path.join(model_dir, 'silero_vad.int8.onnx')
+    # Quantize once and reuse the result on later starts
+    if not os.path.exists(int8_path):
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8,
+                         extra_options={'EnableSubgraph': True})
+    return OnnxVAD(int8_path)
+
+
+def freeze_model(model):
+    """Freeze the TorchScript model so weights become graph constants"""
+    try:
+        frozen = torch.jit.freeze(model, preserved_attrs=['reset_states'])
+        # The model updates its own state in forward, so make sure the frozen
+        # graph gives the same probabilities over consecutive chunks
+        generator = torch.Generator().manual_seed(0)
+        chunks = torch.randn(8, 1, VAD_CHUNK_SIZE, generator=generator) * 0.1
+        model.reset_states()
+        frozen.reset_states()
+        with torch.inference_mode():
+            expected = torch.cat([model(chunk, SAMPLE_RATE) for chunk in chunks])
+            actual = torch.cat([frozen(chunk, SAMPLE_RATE) for chunk in chunks])
+        model.reset_states()
+        frozen.reset_states()
+        if not torch.allclose(expected, actual, atol=1e-5):
+            log.warning("Frozen VAD model disagrees with the original, using it as loaded")
+            return model
+        return frozen
+    except Exception as e:
+        log.warning("Could not freeze VAD model, using it as loaded: %s", e)
+        model.reset_states()
+        return model
+
+
 # Configure Silero VAD
+# Set VAD_USE_ONNX=1 to run the int8-quantized ONNX model (needs onnxruntime)
+USE_ONNX = os.environ.get("VAD_USE_ONNX", "0") == "1"
+# Set VAD_FREEZE=0 to run the TorchScript model exactly as loaded
+FREEZE_MODEL = os.environ.get("VAD_FREEZE", "1") == "1"
 torch.set_num_threads(1)
 model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
                              model='silero_vad')
+if USE_ONNX:
+    model = load_onnx_model()
+else:
+    model.eval()
+    if FREEZE_MODEL:
+        model = freeze_model(model)
 
 (get_speech_timestamps,
  save_audio,
@@ -19,14 +129,9 @@ model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad',
  VADIterator,
  collect_chunks) = utils
 
-# Audio parameters
-SAMPLE_RATE = 16000
-# Silero VAD requires exactly 512 samples per chunk at 16kHz
-VAD_CHUNK_SIZE = 512
 audio_chunks = []
 import time
 import wave
-import os
 def save_recorded_audio():
     """Save the recorded audio to a WAV file"""
     if not audio_chunks:
@@ -38,17 +143,17 @@ def save_recorded_audio():
     filename = f"vad_recording_{timestamp}.wav"
     filepath = os.path.join("recordings", filename)
     
-    # Combine all audio chunks
-    combined_audio = b''.join(audio_chunks)
-    
-    # Save to WAV file
-    with wave.open(filepath, 'wb') as wf:
+    # Stream the chunks through a 1 MB buffer instead of joining them first
+    with open(filepath, 'wb', buffering=1 << 20) as raw, wave.open(raw, 'wb') as wf:
         wf.setnchannels(1)  # Mono
         wf.setsampwidth(2)  # 16-bit
         wf.setframerate(SAMPLE_RATE)
-        wf.writeframes(combined_audio)
+        # writeframesraw leaves the header alone; writeframes would seek
+        # back to patch it (flushing the buffer) after every chunk
+        for chunk in audio_chunks:
+            wf.writeframesraw(chunk)
     
-    size_kb = len(combined_audio) / 1024
+    size_kb = sum(len(chunk) for chunk in audio_chunks) / 1024
     print(f"Recording saved to {filepath}, size: {size_kb:.2f}KB")
     # Clear the chunks after saving
     audio_chunks.clear()
@@ -58,147 +163,213 @@ def save_recorded_audio():
 class VADProcessor:
     def __init__(self):
         self.speech_detected = False
-        self.accumulated_audio = []
+        self.accumulated_audio = bytearray()
+        self._continue_ctr = 0
+        self._gated = False
+        # Silero keeps RNN state inside the model, so every stream needs its
+        # own copy or concurrent streams would interleave their state
+        self.model = copy.deepcopy(model)
+        self.model.reset_states()
+        # Reused model input buffer
+        self._buf = torch.empty(1, VAD_CHUNK_SIZE, dtype=torch.float32)
+        self._buf_np = self._buf.numpy()  # shares memory with _buf
+        self._scale = np.float32(1.0 / 32768.0)
         
     def process_chunk(self, audio_chunk):
+        """Run VAD on one chunk and return its (status, payload) event.
+
+        The payload is the utterance audio for "end" and the continue count
+        for "heartbeat", otherwise None.
+        """
         try:
             # global audio_chunks
             # audio_chunks.append(audio_chunk)
             # if len(audio_chunks) > 1000:
             #     save_recorded_audio()
-            audio_int16 = np.frombuffer(audio_chunk, np.int16)
-            # Check if we have the right number of samples
-            if len(audio_int16) != VAD_CHUNK_SIZE:
-                print(f"Warning: Expected {VAD_CHUNK_SIZE} samples, got {len(audio_int16)}")
-                # Pad or truncate to the right size
-                if len(audio_int16) > VAD_CHUNK_SIZE:
-                    audio_int16 = audio_int16[:VAD_CHUNK_SIZE]
-                else:
-                    padding = np.zeros(VAD_CHUNK_SIZE - len(audio_int16), dtype=np.int16)
-                    audio_int16 = np.concatenate([audio_int16, padding])
-            
-            # Convert to float32 and normalize
-            audio_float32 = audio_int16.astype(np.float32) / 32768.0
-            
-            # Process through VAD
-            # Make sure we have a properly shaped tensor for VAD input
-            audio_tensor = torch.from_numpy(audio_float32)
-            
-            # The VAD model expects a specific format
-            if audio_tensor.dim() == 1:
-                # Ensure it's the right shape (a single batch)
-                audio_tensor = audio_tensor.unsqueeze(0)
-            
-            # Apply the VAD model directly instead of using the iterator
-            # This is more reliable in some cases
-            speech_prob = model(audio_tensor, SAMPLE_RATE).item()
-            
-            # Record audio for potential STT processing
-            self.accumulated_audio.append(audio_chunk)
-            
-            # Use probability threshold to determine speech
-            speech_detected_now = speech_prob > 0.7
+            if not self.speech_detected and self._is_silence(audio_chunk):
+                if not self._gated:
+                    # The model won't see this gap, so don't let the next
+                    # scored chunk reuse state from before it
+                    self.model.reset_states()
+                    self._gated = True
+                self.accumulated_audio.extend(audio_chunk)
+                return self._continue()
+            self._gated = False
             
-            # Check for speech events
-            if speech_detected_now and not self.speech_detected:
-                self.speech_detected = True
-                return "start"
-            elif not speech_detected_now and self.speech_detected:
-                self.speech_detected = False
-                return "end"
-            else:
-                return "continue"
-                
+            self._load(audio_chunk)
+            with torch.inference_mode():
+                speech_prob = self.model(self._buf, SAMPLE_RATE).item()
+            return self._update(audio_chunk, speech_prob)
         except Exception as e:
-            print(f"Error in process_chunk: {e}")
+            log.error("Error in process_chunk: %s", e)
             # Return continue to avoid breaking the stream
-            return "continue"
+            return "continue", None
+    
+    def _is_silence(self, audio_chunk):
+        """Cheap energy check used to skip the model on quiet chunks"""
+        if SILENCE_GATE <= 0:
+            return False
+        audio_int16 = np.frombuffer(audio_chunk, np.int16)
+        return np.abs(audio_int16, dtype=np.int32).mean() < SILENCE_GATE
+    
+    def _load(self, audio_chunk):
+        """Write a chunk into the input buffer as normalized float32"""
+        if len(audio_chunk) == VAD_CHUNK_BYTES:
+            audio_int16 = np.frombuffer(audio_chunk, np.int16)
+        else:
+            # Slow path: pad or truncate to the size the model expects
+            audio_int16 = self._to_int16(audio_chunk)
+        # Cast and scale in one vectorized pass, straight into the buffer
+        np.multiply(audio_int16, self._scale, out=self._buf_np[0], dtype=np.float32)
+    
+    def _to_int16(self, audio_chunk):
+        """Returns the chunk as exactly VAD_CHUNK_SIZE int16 samples"""
+        audio_int16 = np.frombuffer(audio_chunk, np.int16)
+        # Check if we have the right number of samples
+        if len(audio_int16) != VAD_CHUNK_SIZE:
+            log.debug("Expected %d samples, got %d", VAD_CHUNK_SIZE, len(audio_int16))
+            # Pad or truncate to the right size
+            if len(audio_int16) > VAD_CHUNK_SIZE:
+                audio_int16 = audio_int16[:VAD_CHUNK_SIZE]
+            else:
+                padding = np.zeros(VAD_CHUNK_SIZE - len(audio_int16), dtype=np.int16)
+                audio_int16 = np.concatenate([audio_int16, padding])
+        return audio_int16
+    
+    def _update(self, audio_chunk, speech_prob):
+        """Update the speech state for one chunk and return its event"""
+        # Record audio for potential STT processing
+        self.accumulated_audio.extend(audio_chunk)
+        
+        # Use probability threshold to determine speech
+        speech_detected_now = speech_prob > 0.7
+        
+        # Check for speech events
+        if speech_detected_now and not self.speech_detected:
+            self.speech_detected = True
+            return "start", None
+        elif not speech_detected_now and self.speech_detected:
+            self.speech_detected = False
+            return "end", self.get_accumulated_audio()
+        else:
+            return self._continue()
+    
+    def _continue(self):
+        """Returns a continue event, turned into a heartbeat every HEARTBEAT_CHUNKS"""
+        self._continue_ctr += 1
+        if self._continue_ctr % HEARTBEAT_CHUNKS == 0:
+            return "heartbeat", self._continue_ctr
+        return "continue", None
     
     def get_accumulated_audio(self):
         """Returns the accumulated audio and clears the buffer"""
-        combined_audio = b''.join(self.accumulated_audio)
-        self.accumulated_audio = []
+        combined_audio = bytes(self.accumulated_audio)
+        self.accumulated_audio.clear()
         return combined_audio
     
     def reset(self):
         """Reset the VAD state"""
-        if hasattr(self, 'vad_iterator'):
-            self.vad_iterator.reset_states()
+        self.model.reset_states()
         self.speech_detected = False
-        self.accumulated_audio = []
+        self.accumulated_audio.clear()
+        self._continue_ctr = 0
+        self._gated = False
 
 
 class VADServicer(vad_pb2_grpc.VADServiceServicer):
     def __init__(self):
-        self.client_processors = {}
+        # Run a few dummy chunks so the first client doesn't pay for lazy init
+        with torch.inference_mode():
+            for _ in range(5):
+                model(torch.zeros(1, VAD_CHUNK_SIZE), SAMPLE_RATE)
+        model.reset_states()
+        # Model calls block, so they run here instead of on the event loop
+        self.model_pool = futures.ThreadPoolExecutor(max_workers=MODEL_WORKERS)
         
-    def ProcessAudio(self, request_iterator, context):
+    async def ProcessAudio(self, request_iterator, context):
         """Process streaming audio and return VAD events"""
-        # Extract client ID from metadata or create a new one
         client_id = context.peer()
+        loop = asyncio.get_running_loop()
         
-        # Create a processor for this client if it doesn't exist
-        if client_id not in self.client_processors:
-            self.client_processors[client_id] = VADProcessor()
-        
-        processor = self.client_processors[client_id]
+        # VAD state lives only as long as this stream, so nothing is kept
+        # around once the client disconnects. Building it copies the model,
+        # so do that off the event loop too.
+        processor = await loop.run_in_executor(self.model_pool, VADProcessor)
         
         try:
-            for request in request_iterator:
+            async for request in request_iterator:
                 # Process the audio chunk
                 audio_chunk = request.audio_data
-                status = processor.process_chunk(audio_chunk)
-                # print(status) 
-                # If speech ended, we can send the accumulated audio for STT processing
-                if status == "end":
-                    audio_data = processor.get_accumulated_audio()
-                    
-                    # Here you would typically send the audio to your STT service
-                    # For demo purposes, we'll just acknowledge it
-                    yield vad_pb2.VADResponse(
-                        event=status,
-                        message=f"Speech ended, {len(audio_data)} bytes processed for STT"
-                    )
-                elif status == "start":
-                    yield vad_pb2.VADResponse(
-                        event=status,
-                        message="Speech detected"
-                    )
-                # We could yield continue events too, but that would create a lot of network traffic
-                # Only uncomment if you need continuous feedback
-                # elif status == "continue":
-                #     yield vad_pb2.VADResponse(
-                #         event=status,
-                #         message="Processing..."
-                #     )
+                status, payload = await loop.run_in_executor(
+                    self.model_pool, processor.process_chunk, audio_chunk)
+                response = self._response(status, payload)
+                if response is not None:
+                    yield response
         except Exception as e:
-            print(f"Error processing audio for client {client_id}: {e}")
-            context.abort(grpc.StatusCode.INTERNAL, f"Error: {str(e)}")
-        finally:
-            # Clean up if the client disconnects
-            if client_id in self.client_processors:
-                self.client_processors[client_id].reset()
-    
-    def ResetVAD(self, request, context):
+            log.error("Error processing audio for client %s: %s", client_id, e)
+            await context.abort(grpc.StatusCode.INTERNAL, f"Error: {str(e)}")
+    
+    def _response(self, status, payload):
+        """Convert a processor event into a VADResponse, or None to send nothing"""
+        # print(status) 
+        # If speech ended, we can send the accumulated audio for STT processing
+        if status == "end":
+            # Here you would typically send the audio to your STT service
+            # For demo purposes, we'll just acknowledge it
+            return vad_pb2.VADResponse(
+                event=status,
+                message=f"Speech ended, {len(payload)} bytes processed for STT"
+            )
+        elif status == "start":
+            return vad_pb2.VADResponse(
+                event=status,
+                message="Speech detected"
+            )
+        # Continue events are folded into one heartbeat every HEARTBEAT_CHUNKS
+        # chunks, giving clients a liveness signal without per-chunk traffic
+        elif status == "heartbeat":
+            return vad_pb2.VADResponse(
+                event=status,
+                message=str(payload)
+            )
+        return None
+    
+    async def ResetVAD(self, request, context):
         """Reset the VAD state for a client"""
-        client_id = context.peer()
-        if client_id in self.client_processors:
-            self.client_processors[client_id].reset()
+        # Every ProcessAudio stream starts from a fresh state, so there is
+        # nothing to reset between calls
         return vad_pb2.ResetResponse(success=True)
 
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+# Flush every write immediately instead of buffering small responses.
+# This costs more syscalls but delivers start/end events without waiting
+# for the HTTP/2 write buffer to fill.
+SERVER_OPTIONS = [
+    ('grpc.http2.write_buffer_size', 0),
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.http2.min_time_between_pings_ms', 10000),
+    ('grpc.http2.max_frame_size', 16384),
+    ('grpc.so_reuseport', 1),
+]
+
+
+async def serve():
+    # One event loop multiplexes all streams instead of a thread per stream
+    server = grpc.aio.server(options=SERVER_OPTIONS)
     vad_pb2_grpc.add_VADServiceServicer_to_server(VADServicer(), server)
     server.add_insecure_port('[::]:50055')
-    server.start()
+    await server.start()
     print("Server started on port 50055")
     try:
-        server.wait_for_termination()
-    except KeyboardInterrupt:
-        server.stop(0)
+        await server.wait_for_termination()
+    finally:
+        await server.stop(0)
         print("Server stopped")
 
 
 if __name__ == '__main__':
-    serve()
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass